@@ -1,7 +1,11 @@
-import itertools
+import copy
+import functools
+import io
 import shutil
+import signal
 import sys
-from typing import Optional, TextIO, Union
+import threading
+from typing import Any, Callable, Dict, Optional, TextIO, Union
 
 import click
 
@@ -15,24 +19,98 @@ from mitmproxy.utils import human
 from mitmproxy.utils import strutils
 from mitmproxy.websocket import WebSocketFlow, WebSocketMessage
 
+_CONTENT_STYLES: Dict[str, Dict[str, Any]] = {
+    "highlight": {"bold": True},
+    "offset": {"fg": "blue"},
+    "header": {"fg": "green", "bold": True},
+    "text": {"fg": "green"},
+}
+_METHOD_COLORS = {
+    "GET": "green",
+    "DELETE": "red",
+}
+_EMPTY: Dict[str, Any] = {}
+_H1_VERSIONS = frozenset(("HTTP/1.0", "HTTP/1.1"))
+# Indexed by status_code // 100.
+_STATUS_COLORS = (None, None, "green", "magenta", "red", "red")
+_BLINK_CODES = frozenset({418})
+_FG = {
+    "red": "\x1b[31m",
+    "green": "\x1b[32m",
+    "yellow": "\x1b[33m",
+    "blue": "\x1b[34m",
+    "magenta": "\x1b[35m",
+}
+_BOLD = "\x1b[1m"
+_RESET = "\x1b[0m"
+
+
+# The terminal width is shared by all dumpers. It is read once and then kept up to date
+# by a single SIGWINCH handler, which also calls whatever handler was installed before.
+_term_width: int = shutil.get_terminal_size()[0]
+_sigwinch_handler_installed: bool = False
+_previous_sigwinch_handler = None
+
+
+def _update_term_width(signum=None, frame=None) -> None:
+    global _term_width
+    _term_width = shutil.get_terminal_size()[0]
+    if callable(_previous_sigwinch_handler):
+        _previous_sigwinch_handler(signum, frame)
+
+
+def _install_sigwinch_handler() -> None:
+    global _sigwinch_handler_installed, _previous_sigwinch_handler
+    if _sigwinch_handler_installed:
+        return
+    # Signal handlers can only be installed from the main thread,
+    # a Dumper created there later on will install it instead.
+    if hasattr(signal, "SIGWINCH") and threading.current_thread() is threading.main_thread():  # pragma: windows no cover
+        _previous_sigwinch_handler = signal.getsignal(signal.SIGWINCH)
+        signal.signal(signal.SIGWINCH, _update_term_width)
+        _sigwinch_handler_installed = True
+
 
 def indent(n: int, text: str) -> str:
-    l = str(text).strip().splitlines()
+    text = str(text).strip()
+    if not text:
+        return ""
     pad = " " * n
-    return "\n".join(pad + i for i in l)
+    return pad + text.replace("\r\n", "\n").replace("\n", "\n" + pad)
+
+
+def _style(text: str, fg: Optional[str] = None, bold: bool = False) -> str:
+    """
+    A faster click.style for the fixed foreground/bold combinations used by the dumper.
+    """
+    prefix = _FG[fg] if fg else ""
+    if bold:
+        prefix += _BOLD
+    return prefix + text + _RESET
 
 
-def colorful(line, styles):
-    yield "    "  # we can already indent here
-    for (style, text) in line:
-        yield click.style(text, **styles.get(style, {}))
+@functools.lru_cache(maxsize=256)
+def _styled_header_key(k: bytes) -> str:
+    # Header names repeat across flows, so escaping and styling them is cached.
+    return _style(strutils.bytes_to_escaped_str(k), fg="blue")
 
 
 class Dumper:
     def __init__(self, outfile=sys.stdout, errfile=sys.stderr):
         self.filter: Optional[flowfilter.TFilter] = None
+        # Refreshed in configure so that disabled or unfiltered dumpers bail out early.
+        self._enabled: bool = True
+        self._has_filter: bool = False
+        self._flow_detail: int = 1
+        # Specialized for the current flow_detail in configure.
+        self._echo_flow_impl: Callable[[http.HTTPFlow, Union[http.Request, http.Response]], None] = self._echo_no_details
         self.outfp: TextIO = outfile
         self.errfp: TextIO = errfile
+        # Output is collected here and written out once per flow or message,
+        # so that a single flow does not result in a write for every line.
+        self._buf = io.StringIO()
+        self._is_tty: bool = getattr(outfile, "isatty", lambda: False)()
+        _install_sigwinch_handler()
 
     def load(self, loader):
         loader.add_option(
@@ -66,39 +144,65 @@ class Dumper:
                     )
             else:
                 self.filter = None
+            self._has_filter = self.filter is not None
+        if "flow_detail" in updated:
+            self._flow_detail = ctx.options.flow_detail
+            self._enabled = self._flow_detail != 0
+            if self._flow_detail >= 3:
+                self._echo_flow_impl = self._echo_full_details
+            elif self._flow_detail == 2:
+                self._echo_flow_impl = self._echo_headers_and_trailers
+            else:
+                self._echo_flow_impl = self._echo_no_details
 
     def echo(self, text: str, ident=None, **style):
+        self._echo(text, ident, **style)
+        self._flush()
+
+    def _echo(self, text: str, ident=None, **style):
         if ident:
             text = indent(ident, text)
-        click.secho(text, file=self.outfp, **style)
-        if self.outfp:
+        # Always emit styles into the buffer, _flush strips them if outfp is not a terminal.
+        click.secho(text, file=self._buf, color=True, **style)
+
+    def _flush(self):
+        text = self._buf.getvalue()
+        if not text:
+            return
+        self._buf.seek(0)
+        self._buf.truncate()
+        if self._is_tty:
+            # click.echo takes care of Windows terminals and flushes outfp.
+            click.echo(text, file=self.outfp, nl=False)
+        else:
+            # Flush once per flow so that pipes (e.g. mitmdump | tee) see complete flows right away
+            # and stay in order with errors written to errfp.
+            self.outfp.write(click.unstyle(text))
             self.outfp.flush()
 
     def echo_error(self, text: str, **style):
         click.secho(text, file=self.errfp, **style)
-        if self.errfp:
-            self.errfp.flush()
+        self.errfp.flush()
 
     def _echo_headers(self, headers: http.Headers):
+        parts = []
         for k, v in headers.fields:
-            ks = strutils.bytes_to_escaped_str(k)
             vs = strutils.bytes_to_escaped_str(v)
-            out = "{}: {}".format(
-                click.style(ks, fg="blue"),
-                click.style(vs)
-            )
-            self.echo(out, ident=4)
+            parts.append("    " + _styled_header_key(k) + ": " + _style(vs))
+        if parts:
+            self._echo("\n".join(parts))
 
     def _echo_trailers(self, trailers: Optional[http.Headers]):
         if not trailers:
             return
-        self.echo(click.style("--- HTTP Trailers", fg="magenta"), ident=4)
+        self._echo(_style("--- HTTP Trailers", fg="magenta"), ident=4)
         self._echo_headers(trailers)
 
     def _echo_message(
         self,
         message: Union[http.Message, TCPMessage, WebSocketMessage],
-        flow: Union[http.HTTPFlow, TCPFlow, WebSocketFlow]
+        flow: Union[http.HTTPFlow, TCPFlow, WebSocketFlow],
+        flow_detail: int,
     ):
         _, lines, error = contentviews.get_message_content_view(
             ctx.options.dumper_default_contentview,
@@ -108,50 +212,42 @@ class Dumper:
         if error:
             ctx.log.debug(error)
 
-        if ctx.options.flow_detail == 3:
-            lines_to_echo = itertools.islice(lines, 70)
-        else:
-            lines_to_echo = lines
-
-        styles = dict(
-            highlight=dict(bold=True),
-            offset=dict(fg="blue"),
-            header=dict(fg="green", bold=True),
-            text=dict(fg="green")
-        )
-
-        content = "\r\n".join(
-            "".join(colorful(line, styles)) for line in lines_to_echo
-        )
+        limit = 70 if flow_detail == 3 else None
+        rendered = []
+        truncated = False
+        for i, line in enumerate(lines):
+            if limit is not None and i >= limit:
+                truncated = True
+                break
+            # we can already indent here
+            rendered.append("    " + "".join([
+                click.style(text, **_CONTENT_STYLES.get(style, _EMPTY))
+                for (style, text) in line
+            ]))
+
+        content = "\r\n".join(rendered)
         if content:
-            self.echo("")
-            self.echo(content)
+            self._echo("")
+            self._echo(content)
 
-        if next(lines, None):
-            self.echo("(cut off)", ident=4, dim=True)
+        if truncated:
+            self._echo("(cut off)", ident=4, dim=True)
 
-        if ctx.options.flow_detail >= 2:
-            self.echo("")
+        if flow_detail >= 2:
+            self._echo("")
 
-    def _echo_request_line(self, flow: http.HTTPFlow) -> None:
+    def _echo_request_line(self, flow: http.HTTPFlow, flow_detail: int, client_addr: str) -> None:
         if flow.client_conn:
-            client = click.style(
-                strutils.escape_control_characters(
-                    human.format_address(flow.client_conn.peername)
-                )
-            )
+            client = _style(strutils.escape_control_characters(client_addr))
         elif flow.is_replay == "request":
-            client = click.style("[replay]", fg="yellow", bold=True)
+            client = _style("[replay]", fg="yellow", bold=True)
         else:
             client = ""
 
         pushed = ' PUSH_PROMISE' if 'h2-pushed-stream' in flow.metadata else ''
         method = flow.request.method + pushed
-        method_color = dict(
-            GET="green",
-            DELETE="red"
-        ).get(method.upper(), "magenta")
-        method = click.style(
+        method_color = _METHOD_COLORS.get(method.upper(), "magenta")
+        method = _style(
             strutils.escape_control_characters(method),
             fg=method_color,
             bold=True
@@ -161,52 +257,45 @@ class Dumper:
         else:
             url = flow.request.url
 
-        if ctx.options.flow_detail <= 1:
+        if flow_detail <= 1:
             # We need to truncate before applying styles, so we just focus on the URL.
-            terminal_width_limit = max(shutil.get_terminal_size()[0] - 25, 50)
+            terminal_width_limit = max(_term_width - 25, 50)
             if len(url) > terminal_width_limit:
                 url = url[:terminal_width_limit] + "…"
-        url = click.style(strutils.escape_control_characters(url), bold=True)
+        url = _style(strutils.escape_control_characters(url), bold=True)
 
         http_version = ""
-        if (
-            not (flow.request.is_http10 or flow.request.is_http11)
-            or flow.request.http_version != getattr(flow.response, "http_version", "HTTP/1.1")
-        ):
+        req_v = flow.request.http_version
+        resp_v = getattr(flow.response, "http_version", "HTTP/1.1")
+        if req_v not in _H1_VERSIONS or req_v != resp_v:
             # Hide version for h1 <-> h1 connections.
-            http_version = " " + flow.request.http_version
+            http_version = " " + req_v
 
-        self.echo(f"{client}: {method} {url}{http_version}")
+        self._echo(f"{client}: {method} {url}{http_version}")
 
-    def _echo_response_line(self, flow: http.HTTPFlow) -> None:
+    def _echo_response_line(self, flow: http.HTTPFlow, flow_detail: int, client_addr: str) -> None:
         if flow.is_replay == "response":
             replay_str = "[replay]"
-            replay = click.style(replay_str, fg="yellow", bold=True)
+            replay = _style(replay_str, fg="yellow", bold=True)
         else:
             replay_str = ""
             replay = ""
 
         assert flow.response
         code_int = flow.response.status_code
-        code_color = None
-        if 200 <= code_int < 300:
-            code_color = "green"
-        elif 300 <= code_int < 400:
-            code_color = "magenta"
-        elif 400 <= code_int < 600:
-            code_color = "red"
+        code_color = _STATUS_COLORS[code_int // 100] if 200 <= code_int < 600 else None
         code = click.style(
             str(code_int),
             fg=code_color,
             bold=True,
-            blink=(code_int == 418),
+            blink=(code_int in _BLINK_CODES),
         )
 
         if not flow.response.is_http2:
             reason = flow.response.reason
         else:
             reason = http.status_codes.RESPONSES.get(flow.response.status_code, "")
-        reason = click.style(
+        reason = _style(
             strutils.escape_control_characters(reason),
             fg=code_color,
             bold=True
@@ -216,54 +305,60 @@ class Dumper:
             size = "(content missing)"
         else:
             size = human.pretty_size(len(flow.response.raw_content))
-        size = click.style(size, bold=True)
+        size = _style(size, bold=True)
 
         http_version = ""
-        if (
-            not (flow.response.is_http10 or flow.response.is_http11)
-            or flow.request.http_version != flow.response.http_version
-        ):
+        resp_v = flow.response.http_version
+        if resp_v not in _H1_VERSIONS or flow.request.http_version != resp_v:
             # Hide version for h1 <-> h1 connections.
-            http_version = f"{flow.response.http_version} "
+            http_version = f"{resp_v} "
 
-        arrows = click.style(" <<", bold=True)
-        if ctx.options.flow_detail == 1:
+        arrows = _style(" <<", bold=True)
+        if flow_detail == 1:
             # This aligns the HTTP response code with the HTTP request method:
             # 127.0.0.1:59519: GET http://example.com/
             #               << 304 Not Modified 0b
-            pad = max(0,
-                      len(human.format_address(flow.client_conn.peername)) - (2 + len(http_version) + len(replay_str)))
+            pad = max(0, len(client_addr) - (2 + len(http_version) + len(replay_str)))
             arrows = " " * pad + arrows
 
-        self.echo(f"{replay}{arrows} {http_version}{code} {reason} {size}")
+        self._echo(f"{replay}{arrows} {http_version}{code} {reason} {size}")
+
+    def _echo_no_details(self, f: http.HTTPFlow, message: Union[http.Request, http.Response]) -> None:
+        pass
+
+    def _echo_headers_and_trailers(self, f: http.HTTPFlow, message: Union[http.Request, http.Response]) -> None:
+        self._echo_headers(message.headers)
+        self._echo_trailers(message.trailers)
+
+    def _echo_full_details(self, f: http.HTTPFlow, message: Union[http.Request, http.Response]) -> None:
+        self._echo_headers(message.headers)
+        self._echo_message(message, f, self._flow_detail)
+        self._echo_trailers(message.trailers)
 
     def echo_flow(self, f: http.HTTPFlow) -> None:
-        if f.request:
-            self._echo_request_line(f)
-            if ctx.options.flow_detail >= 2:
-                self._echo_headers(f.request.headers)
-            if ctx.options.flow_detail >= 3:
-                self._echo_message(f.request, f)
-            if ctx.options.flow_detail >= 2:
-                self._echo_trailers(f.request.trailers)
-
-        if f.response:
-            self._echo_response_line(f)
-            if ctx.options.flow_detail >= 2:
-                self._echo_headers(f.response.headers)
-            if ctx.options.flow_detail >= 3:
-                self._echo_message(f.response, f)
-            if ctx.options.flow_detail >= 2:
-                self._echo_trailers(f.response.trailers)
-
-        if f.error:
-            msg = strutils.escape_control_characters(f.error.msg)
-            self.echo(f" << {msg}", bold=True, fg="red")
+        # Always write out what has been rendered so far, so that a failure does not leak into the next flow.
+        try:
+            client_addr = human.format_address(f.client_conn.peername) if f.client_conn else ""
+            if f.request:
+                self._echo_request_line(f, self._flow_detail, client_addr)
+                self._echo_flow_impl(f, f.request)
+            if f.response:
+                self._echo_response_line(f, self._flow_detail, client_addr)
+                self._echo_flow_impl(f, f.response)
+            if f.error:
+                msg = strutils.escape_control_characters(f.error.msg)
+                self._echo(f" << {msg}", bold=True, fg="red")
+        finally:
+            self._flush()
+
+    def done(self):
+        self._flush()
+        self.outfp.flush()
 
     def match(self, f):
-        if ctx.options.flow_detail == 0:
+        if not self._enabled:
             return False
-        if not self.filter:
+        if not self._has_filter:
             return True
         elif flowfilter.match(self.filter, f):
             return True
@@ -279,35 +374,39 @@ class Dumper:
 
     def websocket_error(self, f):
         self.echo_error(
-            "Error in WebSocket connection to {}: {}".format(
-                human.format_address(f.server_conn.address), f.error
-            ),
+            f"Error in WebSocket connection to {human.format_address(f.server_conn.address)}: {f.error}",
             fg="red"
         )
 
     def websocket_message(self, f):
         if self.match(f):
             message = f.messages[-1]
-            self.echo(f.message_info(message))
-            if ctx.options.flow_detail >= 3:
-                message = message.from_state(message.get_state())
-                message.content = message.content.encode() if isinstance(message.content, str) else message.content
-                self._echo_message(message, f)
+            try:
+                self._echo(f.message_info(message))
+                flow_detail = self._flow_detail
+                if flow_detail >= 3:
+                    if isinstance(message.content, str):
+                        # Content views expect bytes, so we need a shallow copy instead of mutating the flow.
+                        content = message.content.encode()
+                        message = copy.copy(message)
+                        message.content = content
+                    self._echo_message(message, f, flow_detail)
+            finally:
+                self._flush()
 
     def websocket_end(self, f):
         if self.match(f):
-            self.echo("WebSocket connection closed by {}: {} {}, {}".format(
-                f.close_sender,
-                f.close_code,
-                f.close_message,
-                f.close_reason))
+            try:
+                self._echo(
+                    f"WebSocket connection closed by {f.close_sender}: {f.close_code} {f.close_message}, {f.close_reason}"
+                )
+            finally:
+                self._flush()
 
     def tcp_error(self, f):
         if self.match(f):
             self.echo_error(
-                "Error in TCP connection to {}: {}".format(
-                    human.format_address(f.server_conn.address), f.error
-                ),
+                f"Error in TCP connection to {human.format_address(f.server_conn.address)}: {f.error}",
                 fg="red"
             )
 
@@ -315,10 +414,12 @@ class Dumper:
         if self.match(f):
             message = f.messages[-1]
             direction = "->" if message.from_client else "<-"
-            self.echo("{client} {direction} tcp {direction} {server}".format(
-                client=human.format_address(f.client_conn.peername),
-                server=human.format_address(f.server_conn.address),
-                direction=direction,
-            ))
-            if ctx.options.flow_detail >= 3:
-                self._echo_message(message, f)
+            client = human.format_address(f.client_conn.peername)
+            server = human.format_address(f.server_conn.address)
+            try:
+                self._echo(f"{client} {direction} tcp {direction} {server}")
+                flow_detail = self._flow_detail
+                if flow_detail >= 3:
+                    self._echo_message(message, f, flow_detail)
+            finally:
+                self._flush()
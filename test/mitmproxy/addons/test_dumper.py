@@ -1,7 +1,10 @@
 import io
 import shutil
+import signal
+import threading
 from unittest import mock
 
+import click
 import pytest
 
 from mitmproxy import exceptions
@@ -12,6 +15,20 @@ from mitmproxy.test import tflow
 from mitmproxy.test import tutils
 
 
+def test_indent():
+    assert dumper.indent(2, " foo\nbar\n") == "  foo\n  bar"
+    assert dumper.indent(4, "foo") == "    foo"
+    assert dumper.indent(4, "") == ""
+    assert dumper.indent(4, " \n ") == ""
+    assert dumper.indent(2, "foo\r\nbar") == "  foo\n  bar"
+
+
+@pytest.mark.parametrize("fg", [None, "red", "green", "yellow", "blue", "magenta"])
+@pytest.mark.parametrize("bold", [False, True])
+def test_style(fg, bold):
+    assert dumper._style("foo", fg=fg, bold=bold) == click.style("foo", fg=fg, bold=bold or None)
+
+
 def test_configure():
     d = dumper.Dumper()
     with taddons.context(d) as ctx:
@@ -122,9 +139,27 @@ def test_echo_body():
     d = dumper.Dumper(sio, sio_err)
     with taddons.context(d) as ctx:
         ctx.configure(d, flow_detail=3)
-        d._echo_message(f.response, f)
+        d._echo_message(f.response, f, 3)
+        d.done()
         t = sio.getvalue()
         assert "cut off" in t
+        sio.truncate(0)
+
+        ctx.configure(d, flow_detail=4)
+        d._echo_message(f.response, f, 4)
+        d.done()
+        t = sio.getvalue()
+        assert "cut off" not in t
+
+
+def test_echo_headers():
+    sio = io.StringIO()
+    d = dumper.Dumper(sio, io.StringIO())
+    with taddons.context(d):
+        d._echo_headers(Headers([(b"foo", b"bar"), (b"baz", b"qux\r\n")]))
+        d._echo_headers(Headers())
+        d.done()
+        assert sio.getvalue() == "    foo: bar\n    baz: qux\\r\\n\n"
 
 
 def test_echo_trailer():
@@ -147,6 +182,7 @@ def test_echo_trailer():
         f.response.trailers = Headers([(b"my-little-response-trailer", b"foobar-response-trailer")])
 
         d.echo_flow(f)
+        d.done()
         t = sio.getvalue()
         assert "content-type" in t
         assert "cut off" in t
@@ -156,6 +192,77 @@ def test_echo_trailer():
         assert "foobar-response-trailer" in t
 
 
+def test_flow_detail_levels():
+    sio = io.StringIO()
+    d = dumper.Dumper(sio, io.StringIO())
+    with taddons.context(d) as ctx:
+        f = tflow.tflow(resp=True)
+        f.response.headers["x-dumper"] = "yes"
+        f.response.content = b"dumped content"
+
+        ctx.configure(d, flow_detail=1)
+        d.echo_flow(f)
+        d.done()
+        t = sio.getvalue()
+        assert "<<" in t
+        assert "x-dumper" not in t
+        sio.seek(0)
+        sio.truncate()
+
+        ctx.configure(d, flow_detail=2)
+        d.echo_flow(f)
+        d.done()
+        t = sio.getvalue()
+        assert "x-dumper" in t
+        assert "dumped content" not in t
+        sio.seek(0)
+        sio.truncate()
+
+        ctx.configure(d, flow_detail=3)
+        d.echo_flow(f)
+        d.done()
+        t = sio.getvalue()
+        assert "x-dumper" in t
+        assert "dumped content" in t
+
+
+def test_echo_flow_error():
+    sio = io.StringIO()
+    d = dumper.Dumper(sio, io.StringIO())
+    with taddons.context(d) as ctx:
+        ctx.configure(d, flow_detail=2)
+        f = tflow.tflow(resp=True)
+        with mock.patch.object(d, "_echo_headers", side_effect=ValueError):
+            with pytest.raises(ValueError):
+                d.echo_flow(f)
+        assert "GET" in sio.getvalue()
+        sio.seek(0)
+        sio.truncate()
+
+        d.echo_flow(f)
+        assert sio.getvalue().count("GET") == 1
+
+
+def test_echo():
+    sio = io.StringIO()
+    d = dumper.Dumper(sio, io.StringIO())
+    d.echo("foo", ident=2, bold=True)
+    assert sio.getvalue() == "  foo\n"
+
+
+def test_echo_flow_override():
+    class MyDumper(dumper.Dumper):
+        def echo_flow(self, f):
+            self.seen = f
+
+    d = MyDumper(io.StringIO(), io.StringIO())
+    with taddons.context(d) as ctx:
+        ctx.configure(d, flow_detail=3)
+        f = tflow.tflow(resp=True)
+        d.response(f)
+        assert d.seen is f
+
+
 def test_echo_request_line():
     sio = io.StringIO()
     sio_err = io.StringIO()
@@ -164,19 +271,22 @@ def test_echo_request_line():
         ctx.configure(d, flow_detail=3, showhost=True)
         f = tflow.tflow(client_conn=None, server_conn=True, resp=True)
         f.is_replay = "request"
-        d._echo_request_line(f)
+        d._echo_request_line(f, 3, "")
+        d.done()
         assert "[replay]" in sio.getvalue()
         sio.truncate(0)
 
         f = tflow.tflow(client_conn=None, server_conn=True, resp=True)
         f.is_replay = None
-        d._echo_request_line(f)
+        d._echo_request_line(f, 3, "")
+        d.done()
         assert "[replay]" not in sio.getvalue()
         sio.truncate(0)
 
         f = tflow.tflow(client_conn=None, server_conn=True, resp=True)
         f.request.http_version = "nonstandard"
-        d._echo_request_line(f)
+        d._echo_request_line(f, 3, "")
+        d.done()
         assert "nonstandard" in sio.getvalue()
         sio.truncate(0)
 
@@ -184,11 +294,64 @@ def test_echo_request_line():
         f = tflow.tflow(client_conn=None, server_conn=True, resp=True)
         terminalWidth = max(shutil.get_terminal_size()[0] - 25, 50)
         f.request.url = "http://address:22/" + ("x" * terminalWidth) + "textToBeTruncated"
-        d._echo_request_line(f)
+        d._echo_request_line(f, 0, "")
+        d.done()
         assert "textToBeTruncated" not in sio.getvalue()
         sio.truncate(0)
 
 
+def test_buffered_output():
+    sio = mock.MagicMock(wraps=io.StringIO())
+    sio.isatty.return_value = True
+    d = dumper.Dumper(sio, io.StringIO())
+    with taddons.context(d) as ctx:
+        ctx.configure(d, flow_detail=2)
+        d.response(tflow.tflow(resp=True))
+        assert sio.write.call_count == 1
+        assert sio.flush.call_count == 1
+        assert "<<" in sio.getvalue()
+
+    sio = mock.MagicMock(wraps=io.StringIO())
+    sio.isatty.return_value = False
+    d = dumper.Dumper(sio, io.StringIO())
+    with taddons.context(d) as ctx:
+        ctx.configure(d, flow_detail=2)
+        d.response(tflow.tflow(resp=True))
+        assert sio.write.call_count == 1
+        assert sio.flush.call_count == 1
+        d.response(tflow.tflow(resp=True))
+        assert sio.write.call_count == 2
+        assert sio.flush.call_count == 2
+        assert "\x1b[" not in sio.getvalue()
+
+
+def test_term_width():
+    dumper.Dumper(io.StringIO(), io.StringIO())
+    previous = mock.Mock()
+    with mock.patch("shutil.get_terminal_size", return_value=(123, 24)), \
+            mock.patch.object(dumper, "_previous_sigwinch_handler", previous):
+        dumper._update_term_width(28, None)
+        assert dumper._term_width == 123
+        previous.assert_called_once_with(28, None)
+    dumper._update_term_width()
+
+
+def test_sigwinch_handler_from_thread():
+    with mock.patch.object(dumper, "_sigwinch_handler_installed", False), \
+            mock.patch.object(dumper, "_previous_sigwinch_handler", None), \
+            mock.patch("signal.signal") as set_handler:
+        t = threading.Thread(target=dumper.Dumper, args=(io.StringIO(), io.StringIO()))
+        t.start()
+        t.join()
+        assert not set_handler.called
+        assert not dumper._sigwinch_handler_installed
+
+        dumper.Dumper(io.StringIO(), io.StringIO())
+        if hasattr(signal, "SIGWINCH"):
+            assert set_handler.called
+            assert dumper._sigwinch_handler_installed
+
+
 class TestContentView:
     @pytest.mark.asyncio
     async def test_contentview(self):
@@ -230,6 +393,13 @@ def test_websocket():
         assert "it's me" in sio.getvalue()
         sio.truncate(0)
 
+        f = tflow.twebsocketflow()
+        f.messages[-1].content = "text message"
+        d.websocket_message(f)
+        assert "text message" in sio.getvalue()
+        assert f.messages[-1].content == "text message"
+        sio.truncate(0)
+
         d.websocket_end(f)
         assert "WebSocket connection closed by" in sio.getvalue()
 